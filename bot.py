@@ -3,13 +3,21 @@ import json
 import asyncio
 import threading
 from datetime import datetime, timezone, time, timedelta
+from itertools import islice
+from time import monotonic
 import math
 from typing import Any, Dict, List, Optional, Tuple
 import re
 from urllib.parse import quote_plus
 
+import aiofiles
 import aiohttp
 from aiohttp import web
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - stdlib json fallback
+    orjson = None
 import os as _os
 from dotenv import load_dotenv
 from telegram import (
@@ -22,9 +30,9 @@ from telegram import (
     KeyboardButton,
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import (
     Application,
-    CommandHandler,
     ContextTypes,
     MessageHandler,
     filters,
@@ -32,10 +40,61 @@ from telegram.ext import (
 
 SUBSCRIBERS_FILE = "subscribers.json"
 
+EPIC_STORE_URL = "https://store.epicgames.com/"
+
+DEFAULT_PREFS = {"locale": "en-US", "country": "US"}
+
+# Subscriber state lives in memory and is flushed to disk asynchronously.
+# Handlers mutate STATE directly and call schedule_save(); the debounced
+# flush keeps sync file I/O off the event loop in the hot callback paths.
+STATE: Dict[str, Any] = {"chat_ids": set(), "users": {}, "offer_subs": {}, "digest": {}}
+_SAVE_HANDLE: Optional[asyncio.TimerHandle] = None
+
+# Shared HTTP session (lazily created) so all fetches reuse pooled keep-alive
+# connections instead of paying DNS + TLS handshakes per call.
+_HTTP: Optional[aiohttp.ClientSession] = None
+
+
+async def get_http() -> aiohttp.ClientSession:
+    global _HTTP
+    if _HTTP is None or _HTTP.closed:
+        _HTTP = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, keepalive_timeout=75),
+            timeout=aiohttp.ClientTimeout(total=20),
+        )
+    return _HTTP
+
+
+async def close_http(app: Optional[Application] = None) -> None:
+    global _HTTP
+    if _HTTP is not None and not _HTTP.closed:
+        await _HTTP.close()
+    _HTTP = None
+
+
+async def on_shutdown(app: Application) -> None:
+    # Flush any debounced state write before the loop goes away
+    if _SAVE_HANDLE is not None:
+        _SAVE_HANDLE.cancel()
+        await _flush_state()
+    if _HEALTH_RUNNER is not None:
+        await _HEALTH_RUNNER.cleanup()
+    await close_http()
+
 # Simple in-memory cache: { (locale, country, kind): {"at": datetime, "items": list} }
 FREE_GAMES_CACHE: Dict[str, Dict[str, Any]] = {}
 TRAILER_CACHE: Dict[str, Dict[str, Any]] = {}
+# Cap concurrent trailer-content fetches so gather() bursts don't hammer the API
+_TRAILER_FETCH_SEM = asyncio.Semaphore(5)
+# Single-flight locks so a burst of requests for one slug fetches only once
+_TRAILER_LOCKS: Dict[str, asyncio.Lock] = {}
 CACHE_TTL_SECONDS = 600  # legacy TTL fallback
+# Epic's endpoint updates infrequently but rotates mid-day (Thursdays 15:00
+# UTC); cap cache lifetime so a rotation shows up within ~15 minutes
+FREE_GAMES_TTL_SECONDS = 900
+# Precompiled regexes for the hot per-game paths
+_SLUG_HASH_RE = re.compile(r"-[0-9a-f]{6}$", re.IGNORECASE)
+_YT_ID_RE = re.compile(r'"videoId":"([A-Za-z0-9_-]{11})"')
 # Menu button labels (with emojis for better visuals)
 MENU_BTN_FREE = "🎁 Free Games"
 MENU_BTN_UPCOMING = "⏳ Upcoming"
@@ -58,24 +117,80 @@ def next_midnight_utc(now: Optional[datetime] = None) -> datetime:
     return datetime.combine(next_day, time.min, tzinfo=timezone.utc)
 
 
+def _seconds_until_midnight_utc() -> float:
+    now = datetime.now(timezone.utc)
+    return (next_midnight_utc(now) - now).total_seconds()
+
+
+def _cache_ttl_seconds() -> float:
+    return min(_seconds_until_midnight_utc(), FREE_GAMES_TTL_SECONDS)
+
+
+def json_loads(raw: Any) -> Any:
+    if orjson is not None:
+        return orjson.loads(raw)
+    if isinstance(raw, (bytes, bytearray)):
+        raw = raw.decode("utf-8")
+    return json.loads(raw)
+
+
+def json_dumps_bytes(data: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+
 def load_json(path: str, default: Any) -> Any:
     try:
         if not os.path.exists(path):
             return default
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(path, "rb") as f:
+            return json_loads(f.read())
     except Exception:
         return default
 
 
 def save_json(path: str, data: Any) -> None:
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(json_dumps_bytes(data))
+    os.replace(tmp_path, path)
+
+
+def load_state() -> None:
+    data = load_json(SUBSCRIBERS_FILE, {})
+    # Keep chat_ids as a set of ints in memory for O(1) membership checks;
+    # normalizing here means no per-job str->int coercion later
+    STATE["chat_ids"] = {int(c) for c in data.get("chat_ids", [])}
+    for key in ("users", "offer_subs", "digest"):
+        STATE[key] = data.get(key, {})
+
 
+def _serializable_state() -> Dict[str, Any]:
+    out = dict(STATE)
+    out["chat_ids"] = sorted(STATE.get("chat_ids", ()))
+    return out
 
-def ensure_files_exist() -> None:
-    if not os.path.exists(SUBSCRIBERS_FILE):
-        save_json(SUBSCRIBERS_FILE, {"chat_ids": [], "users": {}, "offer_subs": {}, "digest": {}})
+
+async def _flush_state() -> None:
+    # Write to a temp file first so a crash mid-write can't corrupt the state
+    tmp_path = SUBSCRIBERS_FILE + ".tmp"
+    async with aiofiles.open(tmp_path, "wb") as f:
+        await f.write(json_dumps_bytes(_serializable_state()))
+    os.replace(tmp_path, SUBSCRIBERS_FILE)
+
+
+def schedule_save() -> None:
+    global _SAVE_HANDLE
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # No loop running (e.g. startup) — fall back to a direct write
+        save_json(SUBSCRIBERS_FILE, _serializable_state())
+        return
+    if _SAVE_HANDLE is not None:
+        _SAVE_HANDLE.cancel()
+    _SAVE_HANDLE = loop.call_later(2.0, lambda: asyncio.create_task(_flush_state()))
 
 
 # --- Minimal HTTP server for Koyeb health checks ---
@@ -97,22 +212,19 @@ def _create_health_app() -> web.Application:
     return app
 
 
-async def _run_http_server_forever() -> None:
+_HEALTH_RUNNER: Optional[web.AppRunner] = None
+
+
+async def start_health_server(app: Application) -> None:
+    # Runs on the bot's own event loop (via post_init) — no extra thread,
+    # no second loop, no idle keep-the-coroutine-alive sleep
+    global _HEALTH_RUNNER
     port = int(os.getenv("PORT", "8000"))
-    app = _create_health_app()
-    runner = web.AppRunner(app)
+    runner = web.AppRunner(_create_health_app())
     await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", port)
-    await site.start()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    _HEALTH_RUNNER = runner
     print(f"Health server listening on 0.0.0.0:{port}")
-    # Keep running forever
-    while True:
-        await asyncio.sleep(3600)
-
-
-def start_health_server_in_background() -> None:
-    thread = threading.Thread(target=lambda: asyncio.run(_run_http_server_forever()), daemon=True)
-    thread.start()
 
 
 def _get_keepalive_url() -> Optional[str]:
@@ -171,6 +283,42 @@ def start_keepalive_thread(interval_seconds: int = 200) -> None:
     thread.start()
 
 
+# Raw freeGamesPromotions payload shared by current + upcoming views.
+# Single-flight locks make concurrent cache misses issue one request.
+_PROMO_CACHE: Dict[str, Dict[str, Any]] = {}
+_PROMO_LOCKS: Dict[str, asyncio.Lock] = {}
+
+
+async def _get_promotions(locale: str = "en-US", country: str = "US") -> List[Dict[str, Any]]:
+    key = f"{locale}|{country}"
+    entry = _PROMO_CACHE.get(key)
+    if entry and monotonic() < entry["expires"]:
+        return entry["elements"]
+    lock = _PROMO_LOCKS.setdefault(key, asyncio.Lock())
+    async with lock:
+        # Re-check under the lock: another task may have fetched meanwhile
+        entry = _PROMO_CACHE.get(key)
+        if entry and monotonic() < entry["expires"]:
+            return entry["elements"]
+        url = (
+            "https://store-site-backend-static.ak.epicgames.com/freeGamesPromotions"
+            f"?locale={locale}&country={country}&allowCountries={country}"
+        )
+        session = await get_http()
+        async with session.get(url) as resp:
+            resp.raise_for_status()
+            # Bypass aiohttp's stdlib-json + content-type sniffing path
+            data = json_loads(await resp.read())
+        elements = (
+            data.get("data", {})
+            .get("Catalog", {})
+            .get("searchStore", {})
+            .get("elements", [])
+        )
+        _PROMO_CACHE[key] = {"expires": monotonic() + _cache_ttl_seconds(), "elements": elements}
+        return elements
+
+
 def _cache_key(locale: str, country: str, kind: str) -> str:
     return f"{locale}|{country}|{kind}"
 
@@ -180,15 +328,16 @@ def _get_cached(locale: str, country: str, kind: str) -> Optional[List[Dict[str,
     entry = FREE_GAMES_CACHE.get(key)
     if not entry:
         return None
-    now = datetime.now(timezone.utc)
-    expires: Optional[datetime] = entry.get("expires")
+    # monotonic ticks: far cheaper per check than building aware datetimes
+    now = monotonic()
+    expires: Optional[float] = entry.get("expires")
     if expires is not None:
         if now >= expires:
             FREE_GAMES_CACHE.pop(key, None)
             return None
     else:
         # Legacy at-based TTL
-        if (now - entry["at"]).total_seconds() > CACHE_TTL_SECONDS:
+        if now - entry["at"] > CACHE_TTL_SECONDS:
             FREE_GAMES_CACHE.pop(key, None)
             return None
     return entry["items"]
@@ -197,58 +346,49 @@ def _get_cached(locale: str, country: str, kind: str) -> Optional[List[Dict[str,
 def _set_cached(locale: str, country: str, kind: str, items: List[Dict[str, Any]]) -> None:
     key = _cache_key(locale, country, kind)
     FREE_GAMES_CACHE[key] = {
-        "at": datetime.now(timezone.utc),
-        "expires": next_midnight_utc(),  # cache until next UTC midnight
+        "at": monotonic(),
+        "expires": monotonic() + _cache_ttl_seconds(),
         "items": items,
     }
 
 
+def _parse_iso(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _promo_windows(el: Dict[str, Any], field: str) -> List[Tuple[Optional[datetime], Optional[datetime]]]:
+    # Parse each element's offer windows once and memoize on the (cached)
+    # element itself — fromisoformat is surprisingly costly in the filter loops
+    cache_field = f"__parsed_{field}"
+    cached = el.get(cache_field)
+    if cached is not None:
+        return cached
+    windows: List[Tuple[Optional[datetime], Optional[datetime]]] = []
+    for offer in (el.get("promotions") or {}).get(field) or []:
+        for po in offer.get("promotionalOffers", []):
+            windows.append((_parse_iso(po.get("startDate")), _parse_iso(po.get("endDate"))))
+    el[cache_field] = windows
+    return windows
+
+
 async def fetch_free_games(locale: str = "en-US", country: str = "US") -> List[Dict[str, Any]]:
     cached = _get_cached(locale, country, kind="current")
     if cached is not None:
         return cached
-    url = (
-        "https://store-site-backend-static.ak.epicgames.com/freeGamesPromotions"
-        f"?locale={locale}&country={country}&allowCountries={country}"
-    )
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, timeout=20) as resp:
-            resp.raise_for_status()
-            data = await resp.json()
-
-    elements = (
-        data.get("data", {})
-        .get("Catalog", {})
-        .get("searchStore", {})
-        .get("elements", [])
-    )
+    elements = await _get_promotions(locale, country)
 
     now = datetime.now(timezone.utc)
     free_now: List[Dict[str, Any]] = []
     for el in elements:
-        promotions = el.get("promotions") or {}
-        current = promotions.get("promotionalOffers") or []
-        if not current:
-            continue
+        windows = _promo_windows(el, "promotionalOffers")
         # Check if any current promotional offer window is active now
-        is_active = False
-        for offer in current:
-            for po in offer.get("promotionalOffers", []):
-                start_str = po.get("startDate")
-                end_str = po.get("endDate")
-                try:
-                    start = datetime.fromisoformat(start_str.replace("Z", "+00:00")) if start_str else None
-                    end = datetime.fromisoformat(end_str.replace("Z", "+00:00")) if end_str else None
-                except Exception:
-                    start = end = None
-                if (start is None or start <= now) and (end is None or now < end):
-                    is_active = True
-                    break
-            if is_active:
-                break
-        if not is_active:
-            continue
-        free_now.append(el)
+        if any((start is None or start <= now) and (end is None or now < end) for start, end in windows):
+            free_now.append(el)
 
     _set_cached(locale, country, kind="current", items=free_now)
     return free_now
@@ -258,113 +398,103 @@ async def fetch_upcoming_games(locale: str = "en-US", country: str = "US") -> Li
     cached = _get_cached(locale, country, kind="upcoming")
     if cached is not None:
         return cached
-    url = (
-        "https://store-site-backend-static.ak.epicgames.com/freeGamesPromotions"
-        f"?locale={locale}&country={country}&allowCountries={country}"
-    )
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, timeout=20) as resp:
-            resp.raise_for_status()
-            data = await resp.json()
-
-    elements = (
-        data.get("data", {})
-        .get("Catalog", {})
-        .get("searchStore", {})
-        .get("elements", [])
-    )
+    elements = await _get_promotions(locale, country)
 
     now = datetime.now(timezone.utc)
     upcoming: List[Dict[str, Any]] = []
     for el in elements:
-        promotions = el.get("promotions") or {}
-        upcoming_offers = promotions.get("upcomingPromotionalOffers") or []
-        if not upcoming_offers:
-            continue
         # Pick if any upcoming window is in the future
         is_future = False
         starts_at: Optional[datetime] = None
-        for offer in upcoming_offers:
-            for po in offer.get("promotionalOffers", []):
-                start_str = po.get("startDate")
-                try:
-                    start = datetime.fromisoformat(start_str.replace("Z", "+00:00")) if start_str else None
-                except Exception:
-                    start = None
-                if start and start > now:
-                    is_future = True
-                    if not starts_at or start < starts_at:
-                        starts_at = start
+        for start, _end in _promo_windows(el, "upcomingPromotionalOffers"):
+            if start and start > now:
+                is_future = True
+                if not starts_at or start < starts_at:
+                    starts_at = start
         if is_future:
             el["__upcomingStart"] = starts_at.isoformat() if starts_at else None
+            # Unix timestamp so consumers can do countdown math without re-parsing
+            el["__upcomingStartTs"] = int(starts_at.timestamp()) if starts_at else None
             upcoming.append(el)
 
     # Sort by soonest start time
-    upcoming.sort(key=lambda e: e.get("__upcomingStart") or "")
+    upcoming.sort(key=lambda e: e.get("__upcomingStartTs") or 0)
     _set_cached(locale, country, kind="upcoming", items=upcoming)
     return upcoming
 
 
 def pick_image_url(el: Dict[str, Any]) -> Optional[str]:
     key_images = el.get("keyImages") or []
-    preferred_types = [
+    preferred_types = (
         "OfferImageWide",
         "DieselStoreFrontWide",
         "DieselStoreFront",
         "Thumbnail",
-    ]
-    # First pass: preferred types
+    )
+    # Single pass: index urls by type, then pick the first preferred hit
+    by_type: Dict[str, str] = {}
+    for img in key_images:
+        img_type = img.get("type")
+        if img_type and img_type not in by_type and img.get("url"):
+            by_type[img_type] = img["url"]
     for ptype in preferred_types:
-        for img in key_images:
-            if img.get("type") == ptype and img.get("url"):
-                return img.get("url")
+        if ptype in by_type:
+            return by_type[ptype]
     # Fallback: any image
     if key_images:
         return key_images[0].get("url")
     return None
 
 
-def build_store_url(el: Dict[str, Any], locale: str = "en-US") -> str:
-    def slug_to_url(slug: str) -> str:
-        slug = (slug or "").lstrip("/")
-        if slug.startswith(("p/", "bundles/", "store/")):
-            return f"https://store.epicgames.com/{locale}/{slug}"
-        return f"https://store.epicgames.com/{locale}/p/{slug}"
+_PATH_PREFIXES = frozenset({"p", "bundles", "store"})
+
+
+def resolve_slug_and_url(el: Dict[str, Any], locale: str = "en-US") -> Tuple[Optional[str], str]:
+    # Walk the mapping chain once and derive both the normalized page slug
+    # (no p/, bundles/, store/ prefix) and the full store URL from it
+    raw: Optional[str] = None
 
     # Prefer catalogNs.mappings with pageType=productHome
     mappings = (el.get("catalogNs") or {}).get("mappings") or []
     for m in mappings:
         if (m.get("pageType") or "").lower() == "producthome" and m.get("pageSlug"):
-            return slug_to_url(m.get("pageSlug"))
-
-    # Next: any mapping with pageSlug
-    for m in mappings:
-        if m.get("pageSlug"):
-            return slug_to_url(m.get("pageSlug"))
+            raw = m.get("pageSlug")
+            break
+    if raw is None:
+        # Next: any mapping with pageSlug
+        for m in mappings:
+            if m.get("pageSlug"):
+                raw = m.get("pageSlug")
+                break
+    if raw is None:
+        # Next: offerMappings if present
+        for m in (el.get("offerMappings") or []):
+            if m.get("pageSlug"):
+                raw = m.get("pageSlug")
+                break
+    if raw is None:
+        # Next: productSlug (may already include path segments), then urlSlug
+        raw = el.get("productSlug") or el.get("urlSlug")
 
-    # Next: offerMappings if present
-    for m in (el.get("offerMappings") or []):
-        if m.get("pageSlug"):
-            return slug_to_url(m.get("pageSlug"))
+    if not raw:
+        return None, EPIC_STORE_URL
 
-    # Next: productSlug (may already include path segments)
-    product_slug = el.get("productSlug")
-    if product_slug:
-        return slug_to_url(product_slug)
+    parts = raw.strip().lstrip("/").split("/")
+    if parts and parts[0] in _PATH_PREFIXES:
+        url = f"{EPIC_STORE_URL}{locale}/{'/'.join(parts)}"
+        parts = parts[1:]
+    else:
+        url = f"{EPIC_STORE_URL}{locale}/p/{'/'.join(parts)}"
+    slug = "/".join(parts)
+    return (slug or None), url
 
-    # Fallback: urlSlug as last resort
-    url_slug = el.get("urlSlug")
-    if url_slug:
-        return slug_to_url(url_slug)
 
-    return "https://store.epicgames.com/"
+def build_store_url(el: Dict[str, Any], locale: str = "en-US") -> str:
+    return resolve_slug_and_url(el, locale)[1]
 
 
 def get_user_prefs(chat_id: int) -> Dict[str, str]:
-    ensure_files_exist()
-    data = load_json(SUBSCRIBERS_FILE, {"chat_ids": [], "users": {}, "offer_subs": {}, "digest": {}})
-    users = data.get("users", {})
-    prefs = users.get(str(chat_id)) or {}
+    prefs = STATE.get("users", {}).get(str(chat_id)) or DEFAULT_PREFS
     return {
         "locale": prefs.get("locale", "en-US"),
         "country": prefs.get("country", "US"),
@@ -372,12 +502,10 @@ def get_user_prefs(chat_id: int) -> Dict[str, str]:
 
 
 def set_user_pref(chat_id: int, key: str, value: str) -> None:
-    ensure_files_exist()
-    data = load_json(SUBSCRIBERS_FILE, {"chat_ids": [], "users": {}, "offer_subs": {}, "digest": {}})
-    users = data.setdefault("users", {})
+    users = STATE.setdefault("users", {})
     user = users.setdefault(str(chat_id), {})
     user[key] = value
-    save_json(SUBSCRIBERS_FILE, data)
+    schedule_save()
 
 
 def get_offer_id(el: Dict[str, Any]) -> Optional[str]:
@@ -393,45 +521,36 @@ def get_offer_id(el: Dict[str, Any]) -> Optional[str]:
 
 
 def is_subscribed_to_offer(chat_id: int, offer_id: str) -> bool:
-    ensure_files_exist()
-    data = load_json(SUBSCRIBERS_FILE, {"chat_ids": [], "users": {}, "offer_subs": {}, "digest": {}})
-    subs = data.get("offer_subs", {}).get(str(chat_id), {})
-    return offer_id in subs
+    return offer_id in STATE.get("offer_subs", {}).get(str(chat_id), {})
 
 
 def subscribe_to_offer(chat_id: int, offer_id: str, title: str, page_slug: Optional[str]) -> None:
-    ensure_files_exist()
-    data = load_json(SUBSCRIBERS_FILE, {"chat_ids": [], "users": {}, "offer_subs": {}, "digest": {}})
-    user_subs = data.setdefault("offer_subs", {}).setdefault(str(chat_id), {})
+    user_subs = STATE.setdefault("offer_subs", {}).setdefault(str(chat_id), {})
     user_subs[offer_id] = {
         "title": title,
         "pageSlug": page_slug or "",
         "notified": False,
     }
-    save_json(SUBSCRIBERS_FILE, data)
+    schedule_save()
 
 
 def unsubscribe_from_offer(chat_id: int, offer_id: str) -> None:
-    ensure_files_exist()
-    data = load_json(SUBSCRIBERS_FILE, {"chat_ids": [], "users": {}, "offer_subs": {}, "digest": {}})
-    user_subs = data.setdefault("offer_subs", {}).setdefault(str(chat_id), {})
+    user_subs = STATE.setdefault("offer_subs", {}).setdefault(str(chat_id), {})
     if offer_id in user_subs:
         user_subs.pop(offer_id, None)
-        save_json(SUBSCRIBERS_FILE, data)
+        schedule_save()
 
 
 async def send_subscriptions_list(chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
-    ensure_files_exist()
-    data = load_json(SUBSCRIBERS_FILE, {"chat_ids": [], "users": {}, "offer_subs": {}, "digest": {}})
-    user_subs: Dict[str, Dict[str, Any]] = data.get("offer_subs", {}).get(str(chat_id), {})
+    user_subs: Dict[str, Dict[str, Any]] = STATE.get("offer_subs", {}).get(str(chat_id), {})
     if not user_subs:
         await context.bot.send_message(chat_id=chat_id, text="You have no game notifications set.")
         return
     rows = []
-    for offer_id, meta in list(user_subs.items())[:12]:  # limit rows
+    for offer_id, meta in islice(user_subs.items(), 12):  # limit rows
         title = meta.get("title") or offer_id
         page_slug = meta.get("pageSlug") or ""
-        url = f"https://store.epicgames.com/en-US/p/{page_slug}" if page_slug else "https://store.epicgames.com/"
+        url = f"{EPIC_STORE_URL}en-US/p/{page_slug}" if page_slug else EPIC_STORE_URL
         rows.append([
             InlineKeyboardButton(text=title[:48], url=url),
             InlineKeyboardButton(text="Unsubscribe", callback_data=f"offer_unsub:{offer_id}"),
@@ -440,32 +559,46 @@ async def send_subscriptions_list(chat_id: int, context: ContextTypes.DEFAULT_TY
     await context.bot.send_message(chat_id=chat_id, text="Your game notifications:", reply_markup=markup)
 
 
-async def send_free_games(chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
-    prefs = get_user_prefs(chat_id)
-    games = await fetch_free_games(locale=prefs["locale"], country=prefs["country"])
+async def send_free_games(
+    chat_id: int,
+    context: ContextTypes.DEFAULT_TYPE,
+    games: Optional[List[Dict[str, Any]]] = None,
+) -> None:
+    if games is None:
+        prefs = get_user_prefs(chat_id)
+        games = await fetch_free_games(locale=prefs["locale"], country=prefs["country"])
     if not games:
         await context.bot.send_message(chat_id=chat_id, text="No free games right now.")
         return
 
-    for el in games:
+    # Resolve slug + store URL once per game; both the trailer fetch and the
+    # send loop below reuse the same resolution
+    resolved = [resolve_slug_and_url(el) for el in games]
+
+    # Trailer lookups are independent I/O — fetch them all concurrently.
+    # Telegram sends stay sequential below to respect per-chat rate limits.
+    async def _trailer_for(el: Dict[str, Any], page_slug: Optional[str]) -> Optional[str]:
+        if not page_slug:
+            return None
+        namespace = str(el.get("namespace") or (el.get("catalogNs") or {}).get("namespace") or "").strip()
+        try:
+            direct, _ = await fetch_trailer_urls(page_slug, namespace=namespace)
+            return direct
+        except Exception:
+            return None
+
+    trailers = await asyncio.gather(
+        *(_trailer_for(el, slug) for el, (slug, _url) in zip(games, resolved))
+    )
+
+    for el, (page_slug, url), trailer_video_url in zip(games, resolved, trailers):
         title = el.get("title", "Free Game")
-        url = build_store_url(el)
         image_url = pick_image_url(el)
         # Compact caption (title only) for better iOS rendering
         caption = f"<b>{title}</b>"
         # Inline "Open" button for each free game
         open_kbd = InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Open", url=url)]])
 
-        # Try to fetch a trailer video using the product page slug
-        page_slug = get_page_slug(el)
-        namespace = str(el.get("namespace") or (el.get("catalogNs") or {}).get("namespace") or "").strip()
-        trailer_video_url: Optional[str] = None
-        if page_slug:
-            try:
-                trailer_video_url, _ = await fetch_trailer_urls(page_slug, namespace=namespace)
-            except Exception:
-                trailer_video_url = None
-
         # Send photo first with compact caption, then trailer (if any)
         if image_url:
             try:
@@ -500,84 +633,91 @@ async def send_free_games(chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> N
                 pass
 
 
-def get_page_slug(el: Dict[str, Any]) -> Optional[str]:
-    def normalize_slug(slug: str) -> str:
-        slug = (slug or "").strip().lstrip("/")
-        # Remove leading path like p/, bundles/, store/
-        parts = slug.split("/")
-        if parts and parts[0] in {"p", "bundles", "store"}:
-            parts = parts[1:]
-        return "/".join(parts)
+async def broadcast_free_games(
+    chat_ids: Any,
+    context: ContextTypes.DEFAULT_TYPE,
+    games_by_chat: Optional[Dict[int, List[Dict[str, Any]]]] = None,
+) -> None:
+    # Bounded fanout: per-chat digests run concurrently, capped well under
+    # Telegram's ~30 msg/sec global limit. Callers that already hold a chat's
+    # free-games list pass it via games_by_chat to skip the re-fetch.
+    sem = asyncio.Semaphore(20)
 
-    mappings = (el.get("catalogNs") or {}).get("mappings") or []
-    for m in mappings:
-        if ((m.get("pageType") or "").lower() == "producthome") and m.get("pageSlug"):
-            return normalize_slug(m.get("pageSlug"))
-    for m in mappings:
-        if m.get("pageSlug"):
-            return normalize_slug(m.get("pageSlug"))
+    async def one(chat_id: int) -> None:
+        async with sem:
+            games = games_by_chat.get(chat_id) if games_by_chat else None
+            await send_free_games(chat_id, context, games=games)
+
+    await asyncio.gather(*(one(c) for c in chat_ids), return_exceptions=True)
 
-    for m in (el.get("offerMappings") or []):
-        if m.get("pageSlug"):
-            return normalize_slug(m.get("pageSlug"))
 
-    product_slug = el.get("productSlug")
-    if product_slug:
-        return normalize_slug(product_slug)
+def get_page_slug(el: Dict[str, Any]) -> Optional[str]:
+    return resolve_slug_and_url(el)[0]
 
-    url_slug = el.get("urlSlug")
-    if url_slug:
-        return normalize_slug(url_slug)
 
+def _trailer_cached(cache_key: str) -> Optional[Tuple[Optional[str], Optional[str]]]:
+    cached = TRAILER_CACHE.get(cache_key)
+    if cached and monotonic() < cached.get("expires", 0.0):
+        return cached.get("direct"), cached.get("youtube")
     return None
 
 
 async def fetch_trailer_urls(page_slug: str, locale: str = "en-US", namespace: str = "") -> Tuple[Optional[str], Optional[str]]:
+    if not page_slug:
+        # Nothing to look up — skip cache keys, locks and candidate building
+        return None, None
     # trailer cache key: namespace|page_slug|locale fallback-independent
     cache_key = f"{namespace}|{page_slug}|{locale}"
-    cached = TRAILER_CACHE.get(cache_key)
-    now = datetime.now(timezone.utc)
-    if cached and now < cached.get("expires", now - timedelta(seconds=1)):
-        return cached.get("direct"), cached.get("youtube")
-
+    hit = _trailer_cached(cache_key)
+    if hit is not None:
+        return hit
+    lock = _TRAILER_LOCKS.setdefault(cache_key, asyncio.Lock())
+    async with lock:
+        # Re-check under the lock: a concurrent caller may have filled the cache
+        hit = _trailer_cached(cache_key)
+        if hit is not None:
+            return hit
+        return await _fetch_trailer_urls_uncached(cache_key, page_slug, locale, namespace)
+
+
+async def _fetch_trailer_urls_uncached(cache_key: str, page_slug: str, locale: str, namespace: str) -> Tuple[Optional[str], Optional[str]]:
     locales_to_try = [locale, "en", "en-GB"]
-    slug_candidates = [page_slug]
-    stripped = re.sub(r"-[0-9a-f]{6}$", "", page_slug, flags=re.IGNORECASE)
-    if stripped and stripped != page_slug:
-        slug_candidates.append(stripped)
+    stripped = _SLUG_HASH_RE.sub("", page_slug)
+    candidates = [page_slug, stripped]
     if namespace:
-        slug_candidates += [
-            f"{namespace}/{page_slug}",
-            f"{namespace}/{stripped}" if stripped else None,
-        ]
-        slug_candidates = [s for s in slug_candidates if s]
+        candidates += [f"{namespace}/{page_slug}", f"{namespace}/{stripped}" if stripped else ""]
+    # dict.fromkeys dedupes while keeping order; falsy entries drop in the same pass
+    slug_candidates = list(dict.fromkeys(s for s in candidates if s))
+    attempts = [(loc, s) for loc in locales_to_try for s in slug_candidates]
 
     data: Optional[Dict[str, Any]] = None
-    async with aiohttp.ClientSession() as session:
-        for loc in locales_to_try:
-            base = f"https://store-content.ak.epicgames.com/api/{loc}/content/products/"
-            for attempt_slug in slug_candidates:
-                content_url = base + attempt_slug
-                try:
-                    async with session.get(content_url, timeout=20) as resp:
-                        resp.raise_for_status()
-                        data = await resp.json()
-                        if attempt_slug != page_slug or loc != locale:
-                            print(f"Content fallback used: '{page_slug}' -> '{attempt_slug}' (locale {loc})")
-                        break
-                except Exception as exc:
-                    print(f"Failed to fetch content for slug '{attempt_slug}' (locale {loc}): {exc}")
-                    data = None
-            if data is not None:
+    session = await get_http()
+    async with _TRAILER_FETCH_SEM:
+        for loc, attempt_slug in attempts:
+            content_url = f"https://store-content.ak.epicgames.com/api/{loc}/content/products/{attempt_slug}"
+            try:
+                async with session.get(content_url) as resp:
+                    resp.raise_for_status()
+                    raw = await resp.read()
+                if len(raw) > 256 * 1024:
+                    # Big marketing payloads: decode off-loop so other chats aren't stalled
+                    data = await asyncio.to_thread(json_loads, raw)
+                else:
+                    data = json_loads(raw)
+                if attempt_slug != page_slug or loc != locale:
+                    print(f"Content fallback used: '{page_slug}' -> '{attempt_slug}' (locale {loc})")
                 break
-        if data is None:
-            # cache negative result for 6 hours to reduce repeated 404s
-            TRAILER_CACHE[cache_key] = {
-                "direct": None,
-                "youtube": None,
-                "expires": now + timedelta(hours=6),
-            }
-            return None, None
+            except Exception as exc:
+                print(f"Failed to fetch content for slug '{attempt_slug}' (locale {loc}): {exc}")
+                data = None
+    if data is None:
+        # cache negative result for 6 hours to reduce repeated 404s
+        TRAILER_CACHE[cache_key] = {
+            "direct": None,
+            "youtube": None,
+            "expires": monotonic() + 6 * 3600,
+        }
+        return None, None
 
     # Prefer structured location: pages -> productHome -> modules
     pages: List[Dict[str, Any]] = data.get("pages") or []
@@ -597,7 +737,7 @@ async def fetch_trailer_urls(page_slug: str, locale: str = "en-US", namespace: s
             if not isinstance(url, str):
                 continue
             low = url.lower()
-            if low.endswith( (".mp4", ".webm", ".mov") ) or ".mp4" in low:
+            if low.endswith((".mp4", ".webm", ".mov")) or ".mp4" in low:
                 return url
         return None
 
@@ -609,41 +749,38 @@ async def fetch_trailer_urls(page_slug: str, locale: str = "en-US", namespace: s
             nonlocal direct, yt
             v = (value or "").strip()
             low = v.lower()
-            if (low.endswith(".mp4") or low.endswith(".webm") or low.endswith(".mov") or ".mp4" in low) and not direct:
+            if (low.endswith((".mp4", ".webm", ".mov")) or ".mp4" in low) and not direct:
                 direct = v
             if ("youtube.com" in low or "youtu.be" in low) and not yt:
                 yt = v
 
-        if isinstance(obj, dict):
-            # Common patterns
-            if obj.get("provider") == "youtube" and obj.get("id") and not yt:
-                yt = f"https://youtu.be/{obj.get('id')}"
-            if "youTubeUrl" in obj and obj["youTubeUrl"] and not yt:
-                consider(obj["youTubeUrl"])
-            if "youtubeUrl" in obj and obj["youtubeUrl"] and not yt:
-                consider(obj["youtubeUrl"])
-            if "videoUrl" in obj and obj["videoUrl"] and not direct:
-                consider(obj["videoUrl"])
-            if "video" in obj and isinstance(obj["video"], dict):
-                # e.g., { video: { sources: [{src: ...}] } }
-                cand = pick_from_sources(obj["video"].get("sources"))
-                direct = direct or cand
-            if "sources" in obj:
-                cand = pick_from_sources(obj.get("sources"))
-                direct = direct or cand
-            # Recurse
-            for v in obj.values():
-                if isinstance(v, (dict, list)):
-                    d, y = scan_modules(v)
-                    direct = direct or d
-                    yt = yt or y
-        elif isinstance(obj, list):
-            for item in obj:
-                d, y = scan_modules(item)
-                direct = direct or d
-                yt = yt or y
-        elif isinstance(obj, str):
-            consider(obj)
+        # Iterative walk with an explicit stack: no frame per node, no recursion
+        # limit on pathological payloads, and we can stop as soon as both URLs
+        # have been found instead of visiting the rest of the document
+        stack: List[Any] = [obj]
+        while stack and not (direct and yt):
+            node = stack.pop()
+            if isinstance(node, dict):
+                # Common patterns first
+                if node.get("provider") == "youtube" and node.get("id") and not yt:
+                    yt = f"https://youtu.be/{node.get('id')}"
+                if node.get("youTubeUrl") and not yt:
+                    consider(node["youTubeUrl"])
+                if node.get("youtubeUrl") and not yt:
+                    consider(node["youtubeUrl"])
+                if node.get("videoUrl") and not direct:
+                    consider(node["videoUrl"])
+                video = node.get("video")
+                if isinstance(video, dict) and not direct:
+                    # e.g., { video: { sources: [{src: ...}] } }
+                    direct = pick_from_sources(video.get("sources"))
+                if "sources" in node and not direct:
+                    direct = pick_from_sources(node.get("sources"))
+                stack.extend(v for v in node.values() if isinstance(v, (dict, list)))
+            elif isinstance(node, list):
+                stack.extend(node)
+            elif isinstance(node, str):
+                consider(node)
         return direct, yt
 
     direct_video: Optional[str] = None
@@ -664,7 +801,7 @@ async def fetch_trailer_urls(page_slug: str, locale: str = "en-US", namespace: s
         TRAILER_CACHE[cache_key] = {
             "direct": None,
             "youtube": None,
-            "expires": now + timedelta(hours=6),
+            "expires": monotonic() + 6 * 3600,
         }
         return None, None
 
@@ -672,28 +809,87 @@ async def fetch_trailer_urls(page_slug: str, locale: str = "en-US", namespace: s
     TRAILER_CACHE[cache_key] = {
         "direct": direct_video,
         "youtube": youtube_link,
-        "expires": now + timedelta(hours=24),
+        "expires": monotonic() + 24 * 3600,
     }
     return direct_video, youtube_link
 
 
+# YouTube search results barely change within a promotion week — cache the
+# scraped videoId per query and single-flight concurrent lookups
+_YT_SEARCH_CACHE: Dict[str, Tuple[float, Optional[str]]] = {}
+_YT_SEARCH_LOCKS: Dict[str, asyncio.Lock] = {}
+_YT_SEARCH_TTL_SECONDS = 24 * 3600
+
+
 async def search_youtube_trailer(query: str) -> Optional[str]:
+    cached = _YT_SEARCH_CACHE.get(query)
+    if cached and monotonic() - cached[0] < _YT_SEARCH_TTL_SECONDS:
+        return cached[1]
+    lock = _YT_SEARCH_LOCKS.setdefault(query, asyncio.Lock())
+    async with lock:
+        cached = _YT_SEARCH_CACHE.get(query)
+        if cached and monotonic() - cached[0] < _YT_SEARCH_TTL_SECONDS:
+            return cached[1]
+        result = await _search_youtube_trailer_uncached(query)
+        _YT_SEARCH_CACHE[query] = (monotonic(), result)
+        return result
+
+
+async def _search_youtube_trailer_uncached(query: str) -> Optional[str]:
     search_url = f"https://www.youtube.com/results?search_query={quote_plus(query)}"
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0 Safari/537.36",
         "Accept-Language": "en-US,en;q=0.9",
     }
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.get(search_url, timeout=20) as resp:
-            if resp.status != 200:
-                return None
-            html = await resp.text()
-    m = re.search(r'\"videoId\":\"([A-Za-z0-9_-]{11})\"', html)
+    session = await get_http()
+    async with session.get(search_url, headers=headers, allow_redirects=False) as resp:
+        if resp.status != 200:
+            return None
+        html = await resp.text()
+    m = _YT_ID_RE.search(html)
     if not m:
         return None
     return f"https://youtu.be/{m.group(1)}"
 
 
+# Per-chat worker queues: update fetching hands handler work off immediately
+# so one chat's slow handler can't stall updates for other chats, while each
+# chat's own updates still run strictly in order.
+_CHAT_QUEUES: Dict[int, asyncio.Queue] = {}
+_CHAT_WORKERS: Dict[int, asyncio.Task] = {}
+_CHAT_WORKER_IDLE_SECONDS = 60
+
+
+async def _chat_worker(chat_id: int, queue: asyncio.Queue) -> None:
+    while True:
+        try:
+            handler, update, context = await asyncio.wait_for(queue.get(), timeout=_CHAT_WORKER_IDLE_SECONDS)
+        except asyncio.TimeoutError:
+            if queue.empty():
+                # Idle: retire; the dispatcher spawns a fresh worker on demand
+                _CHAT_WORKERS.pop(chat_id, None)
+                return
+            continue
+        try:
+            await handler(update, context)
+        except Exception as exc:
+            print(f"Handler error for chat {chat_id}: {exc}")
+
+
+def dispatch_per_chat(handler):
+    async def dispatcher(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        chat = update.effective_chat
+        if chat is None:
+            await handler(update, context)
+            return
+        queue = _CHAT_QUEUES.setdefault(chat.id, asyncio.Queue())
+        queue.put_nowait((handler, update, context))
+        worker = _CHAT_WORKERS.get(chat.id)
+        if worker is None or worker.done():
+            _CHAT_WORKERS[chat.id] = asyncio.create_task(_chat_worker(chat.id, queue))
+    return dispatcher
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text("Hi! Use the quick menu below.", reply_markup=get_main_keyboard())
 
@@ -709,29 +905,26 @@ async def upcoming_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     if not games:
         await update.message.reply_text("No upcoming free games found.")
         return
-    now = datetime.now(timezone.utc)
+    now_ts = int(datetime.now(timezone.utc).timestamp())
     for el in games[:6]:  # limit spam
         title = el.get("title", "Upcoming Free Game")
-        url = build_store_url(el)
+        _slug, url = resolve_slug_and_url(el)
         image_url = pick_image_url(el)
-        start_iso = el.get("__upcomingStart")
+        start_ts = el.get("__upcomingStartTs")
         when = "Coming soon"
-        if start_iso:
-            try:
-                start_dt = datetime.fromisoformat(start_iso)
-                total_seconds = max(0, int((start_dt - now).total_seconds()))
-                if total_seconds < 3600:
-                    mins = max(1, total_seconds // 60)
-                    when = f"in {mins:02d} min"
+        if start_ts:
+            # Pure integer countdown — the timestamp was precomputed at fetch time
+            total_seconds = max(0, start_ts - now_ts)
+            if total_seconds < 3600:
+                mins = max(1, total_seconds // 60)
+                when = f"in {mins:02d} min"
+            else:
+                days = total_seconds // 86400
+                hours = (total_seconds % 86400) // 3600
+                if days > 0:
+                    when = f"in {days} day{'s' if days != 1 else ''} and {hours} hour{'s' if hours != 1 else ''}"
                 else:
-                    days = total_seconds // 86400
-                    hours = (total_seconds % 86400) // 3600
-                    if days > 0:
-                        when = f"in {days} day{'s' if days != 1 else ''} and {hours} hour{'s' if hours != 1 else ''}"
-                    else:
-                        when = f"in {hours} hour{'s' if hours != 1 else ''}"
-            except Exception:
-                pass
+                    when = f"in {hours} hour{'s' if hours != 1 else ''}"
         # Cleaner, compact caption for iOS
         caption = f"<b>{title}</b>\n{when}"
         # Show per-game notify toggle + compact Open button in one row
@@ -762,28 +955,22 @@ async def upcoming_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 
 async def subscribe_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    ensure_files_exist()
-    data = load_json(SUBSCRIBERS_FILE, {"chat_ids": [], "users": {}})
-    chat_ids: List[int] = data.get("chat_ids", [])
+    chat_ids: set = STATE.setdefault("chat_ids", set())
     chat_id = update.effective_chat.id
     if chat_id not in chat_ids:
-        chat_ids.append(chat_id)
-        data["chat_ids"] = chat_ids
-        save_json(SUBSCRIBERS_FILE, data)
+        chat_ids.add(chat_id)
+        schedule_save()
         await update.message.reply_text("Subscribed. You'll get a daily reminder.")
     else:
         await update.message.reply_text("You're already subscribed.")
 
 
 async def unsubscribe_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    ensure_files_exist()
-    data = load_json(SUBSCRIBERS_FILE, {"chat_ids": [], "users": {}})
-    chat_ids: List[int] = data.get("chat_ids", [])
+    chat_ids: set = STATE.setdefault("chat_ids", set())
     chat_id = update.effective_chat.id
     if chat_id in chat_ids:
-        chat_ids.remove(chat_id)
-        data["chat_ids"] = chat_ids
-        save_json(SUBSCRIBERS_FILE, data)
+        chat_ids.discard(chat_id)
+        schedule_save()
         await update.message.reply_text("Unsubscribed.")
     else:
         await update.message.reply_text("You were not subscribed.")
@@ -807,37 +994,50 @@ async def setcountry_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await update.message.reply_text(f"Country set to {country.upper()}")
 
 
-async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+# Callback handlers, one per data prefix — PTB's compiled pattern matching
+# routes each press straight to its coroutine with no Python-level dispatch
+
+
+async def _clear_reply_markup(q: Any) -> None:
+    # Check first so the common no-markup case skips the API call (and the
+    # exception unwind); only "message too old/unchanged" style errors are
+    # expected here, so catch just BadRequest
+    if q.message and q.message.reply_markup:
+        try:
+            await q.edit_message_reply_markup(reply_markup=None)
+        except BadRequest:
+            pass
+
+
+async def on_sub_toggle_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     q = update.callback_query
     await q.answer()
-    data = q.data or ""
-    if data.startswith("sub:"):
-        flag = data.split(":", 1)[1]
-        if flag == "1":
-            # Reuse subscribe logic
-            ensure_files_exist()
-            store = load_json(SUBSCRIBERS_FILE, {"chat_ids": [], "users": {}})
-            chat_ids: List[int] = store.get("chat_ids", [])
-            if q.message.chat.id not in chat_ids:
-                chat_ids.append(q.message.chat.id)
-                store["chat_ids"] = chat_ids
-                save_json(SUBSCRIBERS_FILE, store)
-                await q.edit_message_reply_markup(reply_markup=None)
-                await q.message.reply_text("Subscribed. You'll get a daily reminder.")
-            else:
-                await q.message.reply_text("You're already subscribed.")
+    flag = (q.data or "").split(":", 1)[1]
+    chat_ids: set = STATE.setdefault("chat_ids", set())
+    if flag == "1":
+        # Reuse subscribe logic
+        if q.message.chat.id not in chat_ids:
+            chat_ids.add(q.message.chat.id)
+            schedule_save()
+            await q.edit_message_reply_markup(reply_markup=None)
+            await q.message.reply_text("Subscribed. You'll get a daily reminder.")
         else:
-            store = load_json(SUBSCRIBERS_FILE, {"chat_ids": [], "users": {}})
-            chat_ids: List[int] = store.get("chat_ids", [])
-            if q.message.chat.id in chat_ids:
-                chat_ids.remove(q.message.chat.id)
-                store["chat_ids"] = chat_ids
-                save_json(SUBSCRIBERS_FILE, store)
-                await q.edit_message_reply_markup(reply_markup=None)
-                await q.message.reply_text("Unsubscribed.")
-            else:
-                await q.message.reply_text("You were not subscribed.")
-    elif data == "action:free":
+            await q.message.reply_text("You're already subscribed.")
+    else:
+        if q.message.chat.id in chat_ids:
+            chat_ids.discard(q.message.chat.id)
+            schedule_save()
+            await q.edit_message_reply_markup(reply_markup=None)
+            await q.message.reply_text("Unsubscribed.")
+        else:
+            await q.message.reply_text("You were not subscribed.")
+
+
+async def on_action_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    q = update.callback_query
+    await q.answer()
+    data = q.data or ""
+    if data == "action:free":
         await send_free_games(q.message.chat.id, context)
         try:
             await q.message.reply_text("Choose an option:", reply_markup=get_main_keyboard())
@@ -849,95 +1049,161 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             effective_chat = q.message.chat
             message = q.message
         await upcoming_cmd(Dummy(), context)
-    elif data.startswith("offer_sub:"):
-        offer_id = data.split(":", 1)[1]
-        # We need at least the title and page slug to store; fetch from a cached view by scanning recent free/upcoming
-        chat_id = q.message.chat.id
-        prefs = get_user_prefs(chat_id)
-        # Merge current and upcoming for lookup
-        current = await fetch_free_games(locale=prefs["locale"], country=prefs["country"])
-        upcoming = await fetch_upcoming_games(locale=prefs["locale"], country=prefs["country"])
-        el = next((e for e in current + upcoming if get_offer_id(e) == offer_id), None)
-        title = el.get("title") if el else offer_id
-        page_slug = get_page_slug(el) if el else None
-        subscribe_to_offer(chat_id, offer_id, title, page_slug)
-        try:
-            await q.edit_message_reply_markup(reply_markup=None)
-        except Exception:
-            pass
-        await q.message.reply_text(f"You'll be notified when '{title}' becomes free.")
-    elif data.startswith("offer_unsub:"):
-        offer_id = data.split(":", 1)[1]
-        chat_id = q.message.chat.id
-        unsubscribe_from_offer(chat_id, offer_id)
-        try:
-            await q.edit_message_reply_markup(reply_markup=None)
-        except Exception:
-            pass
-        await q.message.reply_text("Game notification removed.")
+
+
+async def on_offer_sub_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    q = update.callback_query
+    await q.answer()
+    offer_id = (q.data or "").split(":", 1)[1]
+    # We need at least the title and page slug to store; the raw promotions
+    # list covers both current and upcoming offers in one lookup
+    chat_id = q.message.chat.id
+    prefs = get_user_prefs(chat_id)
+    elements = await _get_promotions(locale=prefs["locale"], country=prefs["country"])
+    el = next((e for e in elements if get_offer_id(e) == offer_id), None)
+    title = el.get("title") if el else offer_id
+    page_slug = get_page_slug(el) if el else None
+    subscribe_to_offer(chat_id, offer_id, title, page_slug)
+    await _clear_reply_markup(q)
+    await q.message.reply_text(f"You'll be notified when '{title}' becomes free.")
+
+
+async def on_offer_unsub_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    q = update.callback_query
+    await q.answer()
+    offer_id = (q.data or "").split(":", 1)[1]
+    unsubscribe_from_offer(q.message.chat.id, offer_id)
+    await _clear_reply_markup(q)
+    await q.message.reply_text("Game notification removed.")
 
 
 async def daily_job(context: ContextTypes.DEFAULT_TYPE) -> None:
-    ensure_files_exist()
-    store = load_json(SUBSCRIBERS_FILE, {"chat_ids": [], "users": {}, "offer_subs": {}, "digest": {}})
-    subs = store.get("chat_ids", [])
-    offer_subs: Dict[str, Dict[str, Any]] = store.get("offer_subs", {})
-    digest_state: Dict[str, Any] = store.get("digest", {})
+    subs = STATE.get("chat_ids", set())
+    offer_subs: Dict[str, Dict[str, Any]] = STATE.setdefault("offer_subs", {})
+    digest_state: Dict[str, Any] = STATE.setdefault("digest", {})
 
     # Only notify when new free games become available (change detection)
     # Build a union of chats to process: those with daily subs or per-offer subs
-    chat_ids_to_process = set(map(int, subs)) | set(map(int, offer_subs.keys()))
+    # (chat_ids are already ints; offer_subs keys are strings on disk)
+    chat_ids_to_process = subs | set(map(int, offer_subs.keys()))
+
+    # Resolve each chat's market from one users lookup instead of going
+    # through get_user_prefs (and its dict build) per chat
+    users: Dict[str, Any] = STATE.get("users", {})
+
+    def _market(chat_id: int) -> Tuple[str, str]:
+        prefs = users.get(str(chat_id)) or DEFAULT_PREFS
+        return prefs.get("locale", "en-US"), prefs.get("country", "US")
+
+    # Warm the free-games cache once per distinct (locale, country) so the
+    # per-chat workers below all hit it instead of racing the fetch
+    distinct_markets = {_market(cid) for cid in chat_ids_to_process}
+    await asyncio.gather(
+        *(fetch_free_games(locale=loc, country=c) for loc, c in distinct_markets),
+        return_exceptions=True,
+    )
 
-    for chat_id in chat_ids_to_process:
-        prefs = get_user_prefs(chat_id)
+    # Per-chat work is independent I/O — run it concurrently under a semaphore
+    # that keeps the notification sends below Telegram's global rate limit
+    sem = asyncio.Semaphore(20)
+    digest_chat_ids: List[int] = []
+    digest_games: Dict[int, List[Dict[str, Any]]] = {}
+    # One "Now free" text per offer id, shared by every chat subscribed to it
+    notify_text_cache: Dict[str, str] = {}
+    dirty = False
+
+    async def _process_chat(chat_id: int) -> None:
+        nonlocal dirty
+        locale, country = _market(chat_id)
         try:
-            current = await fetch_free_games(locale=prefs["locale"], country=prefs["country"])
-        except Exception:
+            # Hard timeout so one hung fetch can't stall the whole job
+            current = await asyncio.wait_for(
+                fetch_free_games(locale=locale, country=country),
+                timeout=10,
+            )
+        except (asyncio.TimeoutError, aiohttp.ClientError):
             current = []
 
         # Hash current free offers list for change detection
         current_ids = [get_offer_id(el) or el.get("title") for el in current]
         current_ids = [cid for cid in current_ids if cid]
-        key = f"{chat_id}|{prefs['locale']}|{prefs['country']}"
+        key = f"{chat_id}|{locale}|{country}"
         last_ids = digest_state.get(key, [])
 
         # Per-offer notifications: if a subscribed upcoming game is now free
-        user_offer_subs = offer_subs.get(str(chat_id), {})
-        free_set = set(current_ids)
+        user_offer_subs = offer_subs.get(str(chat_id)) or {}
+        free_set = frozenset(current_ids)
         any_change = False
         # Detect new free offers since last check
-        new_free = [cid for cid in current_ids if cid not in set(last_ids)]
-        if new_free:
+        last_set = set(last_ids)
+        if any(cid not in last_set for cid in current_ids):
             any_change = True
-        # Send per-offer notifications
-        for oid, meta in user_offer_subs.items():
-            if oid in free_set and not meta.get("notified"):
+        # Send per-offer notifications concurrently; flags are only set after
+        # a send succeeds, so failures retry on the next run
+        async def _notify(oid: str, meta: Dict[str, Any]) -> None:
+            nonlocal any_change, dirty
+            text = notify_text_cache.get(oid)
+            if text is None:
+                slug = meta.get("pageSlug")
                 title = meta.get("title") or oid
-                url = f"https://store.epicgames.com/en-US/p/{meta.get('pageSlug')}" if meta.get("pageSlug") else "https://store.epicgames.com/"
-                try:
-                    await context.bot.send_message(chat_id=chat_id, text=f"Now free: {title}\n{url}")
-                    meta["notified"] = True
-                    any_change = True
-                except Exception:
-                    pass
-
-        # If there is a change in free games, send the digest once using the existing renderer
-        if any_change and subs and chat_id in subs:
+                url = f"{EPIC_STORE_URL}en-US/p/{slug}" if slug else EPIC_STORE_URL
+                text = f"Now free: {title}\n{url}"
+                notify_text_cache[oid] = text
             try:
-                await send_free_games(chat_id, context)
-            except Exception:
-                pass
+                async with sem:
+                    await asyncio.wait_for(
+                        # No link preview: skips Telegram's server-side URL fetch
+                        context.bot.send_message(chat_id=chat_id, text=text, disable_web_page_preview=True),
+                        timeout=5,
+                    )
+            except (asyncio.TimeoutError, TelegramError):
+                return
+            meta["notified"] = True
+            any_change = True
+            dirty = True
+
+        # Common case when nothing new dropped: no offer subs or no free games
+        if user_offer_subs and free_set:
+            to_notify = [
+                (oid, meta)
+                for oid, meta in user_offer_subs.items()
+                if oid in free_set and not meta.get("notified")
+            ]
+            if to_notify:
+                await asyncio.gather(*(_notify(oid, meta) for oid, meta in to_notify), return_exceptions=True)
+
+        # If there is a change in free games, send the digest once using the
+        # existing renderer, reusing the list fetched above
+        if any_change and subs and chat_id in subs:
+            digest_chat_ids.append(chat_id)
+            digest_games[chat_id] = current
+
+        if digest_state.get(key) != current_ids:
+            digest_state[key] = current_ids
+            dirty = True
+        offer_subs[str(chat_id)] = user_offer_subs
+
+    await asyncio.gather(*(_process_chat(cid) for cid in chat_ids_to_process), return_exceptions=True)
 
-        # Persist digest state and per-offer notifications
-        digest_state[key] = current_ids
-        store["digest"] = digest_state
-        store["offer_subs"][str(chat_id)] = user_offer_subs
-        save_json(SUBSCRIBERS_FILE, store)
+    # Persist digest state and per-offer notifications once for the whole run
+    if dirty:
+        schedule_save()
+
+    if digest_chat_ids:
+        await broadcast_free_games(digest_chat_ids, context, games_by_chat=digest_games)
 
 
 def main() -> None:
+    # uvloop substantially cuts asyncio dispatch overhead for this I/O-heavy
+    # workload; optional since it doesn't support Windows
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
     load_dotenv()
-    
+
     token = os.getenv("TELEGRAM_BOT_TOKEN")
     if not token:
         print("Error: TELEGRAM_BOT_TOKEN not found in environment variables")
@@ -945,25 +1211,50 @@ def main() -> None:
         print("TELEGRAM_BOT_TOKEN=your_bot_token_here")
         return
 
-    ensure_files_exist()
+    load_state()
 
-    # Start lightweight HTTP server for Koyeb health checks
-    start_health_server_in_background()
     # Start background keepalive pings every ~200s to prevent deep sleep
     start_keepalive_thread(interval_seconds=200)
 
-    app = Application.builder().token(token).build()
+    # Webhook mode (WEBHOOK_URL set) binds PORT itself and Telegram pushes
+    # updates; polling mode runs the health server on PORT via post_init
+    webhook_url = os.getenv("WEBHOOK_URL")
+    builder = Application.builder().token(token).post_shutdown(on_shutdown)
+    if not webhook_url:
+        builder = builder.post_init(start_health_server)
+    app = builder.build()
+
+    # Single command router: one handler scan + dict lookup per update
+    # instead of seven CommandHandler passes
+    command_handlers = {
+        "start": start,
+        "freegames": freegames_cmd,
+        "upcoming": upcoming_cmd,
+        "subscribe": subscribe_cmd,
+        "unsubscribe": unsubscribe_cmd,
+        "setlocale": setlocale_cmd,
+        "setcountry": setcountry_cmd,
+    }
 
-    # Commands
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("freegames", freegames_cmd))
-    app.add_handler(CommandHandler("upcoming", upcoming_cmd))
-    app.add_handler(CommandHandler("subscribe", subscribe_cmd))
-    app.add_handler(CommandHandler("unsubscribe", unsubscribe_cmd))
-    app.add_handler(CommandHandler("setlocale", setlocale_cmd))
-    app.add_handler(CommandHandler("setcountry", setcountry_cmd))
+    async def _command_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        parts = (update.message.text or "").split()
+        if not parts:
+            return
+        cmd, _, mention = parts[0][1:].partition("@")
+        if mention and mention.lower() != (context.bot.username or "").lower():
+            return  # command addressed to a different bot in a group
+        handler = command_handlers.get(cmd.lower())
+        if handler is not None:
+            context.args = parts[1:]
+            await handler(update, context)
+        # Unknown commands stay silent, like the text fallback
+
+    app.add_handler(MessageHandler(filters.COMMAND, dispatch_per_chat(_command_router)))
     from telegram.ext import CallbackQueryHandler
-    app.add_handler(CallbackQueryHandler(on_callback))
+    app.add_handler(CallbackQueryHandler(dispatch_per_chat(on_sub_toggle_cb), pattern=r"^sub:"))
+    app.add_handler(CallbackQueryHandler(dispatch_per_chat(on_action_cb), pattern=r"^action:"))
+    app.add_handler(CallbackQueryHandler(dispatch_per_chat(on_offer_sub_cb), pattern=r"^offer_sub:"))
+    app.add_handler(CallbackQueryHandler(dispatch_per_chat(on_offer_unsub_cb), pattern=r"^offer_unsub:"))
 
     # Fallback: do nothing (suppress hint messages)
     async def _fallback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -991,7 +1282,7 @@ def main() -> None:
         return
 
     # Menu router handler (runs before fallback)
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text_menu), group=0)
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, dispatch_per_chat(on_text_menu)), group=0)
 
     # Schedule a daily job at 10:00 UTC (if JobQueue is available)
     if app.job_queue is not None:
@@ -1003,7 +1294,19 @@ def main() -> None:
               "Install with: pip install \"python-telegram-bot[job-queue]\"")
 
     print("Bot is starting...")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Only message + callback_query updates are handled — narrowing the
+    # subscription cuts inbound bandwidth and per-update parse cost
+    allowed_updates = ["message", "callback_query"]
+    if webhook_url:
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv("PORT", "8000")),
+            webhook_url=webhook_url,
+            secret_token=os.getenv("WEBHOOK_SECRET") or None,
+            allowed_updates=allowed_updates,
+        )
+    else:
+        app.run_polling(allowed_updates=allowed_updates)
 
 
 if __name__ == "__main__":